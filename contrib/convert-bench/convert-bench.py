@@ -0,0 +1,514 @@
+#!/usr/bin/python
+
+## Offline throughput benchmark for the contrib converters
+##
+## Generates synthetic Mercurial histories and zip archive series,
+## converts them end-to-end with contrib/hg-to-git/hg-to-git.py and
+## contrib/fast-import/import-zips.py into scratch repositories, and
+## reports the results as JSON.  For example:
+##
+##  python convert-bench.py --hg-revs=200 --zips=50 -o before.json
+##  (apply converter changes)
+##  python convert-bench.py --hg-revs=200 --zips=50 -o after.json
+
+import os, os.path, sys
+import getopt, random, shutil, subprocess, tempfile, time, zlib
+import json, platform
+from zipfile import ZipFile, ZipInfo, ZIP_DEFLATED
+
+bench_dir = os.path.dirname(os.path.abspath(sys.argv[0]))
+contrib_dir = os.path.dirname(bench_dir)
+converters = {
+    'hg-to-git': os.path.join(contrib_dir, 'hg-to-git', 'hg-to-git.py'),
+    'import-zips': os.path.join(contrib_dir, 'fast-import', 'import-zips.py'),
+}
+
+# Commands whose invocations are counted through PATH shims
+counted_commands = ('git', 'hg')
+
+format_version = 1
+
+# Smallest file or member size that still leaves room after the
+# "<name> version <N>" header for versions to differ
+min_file_size = 64
+
+#------------------------------------------------------------------------------
+
+def usage():
+
+    print """\
+%s: [OPTIONS]
+
+options:
+    -o, --output=FILE:        write the JSON report to FILE (default: stdout)
+    -r, --repeat=INT:         convert each input INT times (default=3)
+        --only=NAME:          run only 'hg-to-git' or 'import-zips'
+        --python=PATH:        interpreter running the converters
+                              (default: the one running this script)
+        --seed=INT:           seed for the synthetic inputs (default=1)
+        --workdir=DIR:        keep inputs and scratch repositories in DIR
+        --no-spawn-count:     do not install the git/hg counting shims
+
+hg-to-git input:
+        --hg-revs=INT:        number of changesets (default=100)
+        --hg-files=INT:       files in the tree (default=50)
+        --hg-file-size=INT:   bytes per file, at least %d (default=2048)
+        --hg-churn=FLOAT:     fraction of files changed per changeset
+                              (default=0.1)
+        --hg-branch-every=INT: fork a new head every INT changesets
+                              (default=10, 0 for a linear history)
+        --hg-merge-every=INT: merge a head back every INT changesets
+                              (default=15, 0 to never merge)
+        --hg-nrepack=INT:     passed to hg-to-git --nrepack (default=0,
+                              repack after every conversion; -1 to skip)
+
+import-zips input:
+        --zips=INT:           number of archives (default=20)
+        --zip-members=INT:    members per archive (default=100)
+        --zip-member-size=INT: bytes per member, at least %d
+                              (default=4096)
+        --zip-churn=FLOAT:    fraction of members rewritten between
+                              consecutive archives (default=0.2)
+""" % (sys.argv[0], min_file_size, min_file_size)
+
+def die(msg):
+    sys.stderr.write('convert-bench: %s\n' % msg)
+    sys.exit(1)
+
+def note(msg):
+    sys.stderr.write(msg + '\n')
+
+#------------------------------------------------------------------------------
+
+def which(cmd):
+    for dir in os.environ.get('PATH', '').split(os.pathsep):
+        full = os.path.join(dir, cmd)
+        if os.path.isfile(full) and os.access(full, os.X_OK):
+            return full
+    return None
+
+def run(cmd, cwd=None, env=None):
+    # Helper for input generation; output is discarded unless it fails
+    p = subprocess.Popen(cmd, cwd=cwd, env=env,
+                         stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    out = p.communicate()[0]
+    if p.returncode:
+        die('%s failed:\n%s' % (' '.join(cmd), out))
+    return out
+
+def tree_size(dir):
+    total = 0
+    for root, dirs, files in os.walk(dir):
+        for f in files:
+            total += os.path.getsize(os.path.join(root, f))
+    return total
+
+class content_source:
+    """Cheap deterministic file contents.
+
+    Every file version is a header naming it followed by a slice of a
+    fixed random block, so contents differ between versions without
+    generating megabytes of random data."""
+
+    def __init__(self, rng):
+        chars = 'abcdefghijklmnopqrstuvwxyz0123456789 \n'
+        self.block = ''.join([rng.choice(chars) for i in range(65536)])
+
+    def get(self, name, version, size):
+        head = '%s version %d\n' % (name, version)
+        start = zlib.crc32('%s %d' % (name, version)) % len(self.block)
+        body = self.block[start:] + self.block[:start]
+        while len(head) + len(body) < size:
+            body += body
+        return (head + body)[:size]
+
+#------------------------------------------------------------------------------
+
+def make_hg_history(dest, opts, rng):
+    """Build a Mercurial repository of opts['hg-revs'] changesets.
+
+    Changesets are committed round-robin onto the open heads; every
+    hg-branch-every changesets a new head is forked from the first
+    one and every hg-merge-every changesets the newest head that has
+    diverged from it is merged back."""
+
+    revs = opts['hg-revs']
+    nfiles = opts['hg-files']
+    size = opts['hg-file-size']
+    nchurn = min(nfiles, max(1, int(nfiles * opts['hg-churn'])))
+    branch_every = opts['hg-branch-every']
+    merge_every = opts['hg-merge-every']
+    content = content_source(rng)
+    version = {}
+    user = 'Bench Author <bench@example.com>'
+    when = 1200000000
+
+    def write(name):
+        version[name] = version.get(name, -1) + 1
+        f = open(os.path.join(dest, name), 'wb')
+        f.write(content.get(name, version[name], size))
+        f.close()
+
+    def commit(rev, msg):
+        run(['hg', 'commit', '-A', '-u', user,
+             '-d', '%d 0' % (when + rev * 60), '-m', msg], cwd=dest)
+
+    def update(rev):
+        run(['hg', 'update', '-C', str(rev)], cwd=dest)
+
+    os.mkdir(dest)
+    run(['hg', 'init'], cwd=dest)
+    for i in range(nfiles):
+        write('file%04d.txt' % i)
+    commit(0, 'initial import')
+
+    # Each head is [rev, diverged]; diverged is set once the first
+    # head has moved past the fork point, so the merge is a real one
+    heads = [[0, True]]
+    stats = {'forks': 0, 'merges': 0}
+    for rev in range(1, revs):
+        if merge_every and rev % merge_every == 0:
+            side = [h for h in heads[1:] if h[1]]
+            if side:
+                other = side[-1]
+                update(heads[0][0])
+                run(['hg', '--config', 'ui.merge=internal:local',
+                     'merge', str(other[0])], cwd=dest)
+                commit(rev, 'merge changeset %d' % other[0])
+                heads.remove(other)
+                heads[0][0] = rev
+                stats['merges'] += 1
+                continue
+        if branch_every and rev % branch_every == 0:
+            head = [heads[0][0], False]
+            heads.append(head)
+            stats['forks'] += 1
+        else:
+            head = heads[rev % len(heads)]
+        update(head[0])
+        for name in rng.sample(sorted(version.keys()), nchurn):
+            write(name)
+        commit(rev, 'changeset %d' % rev)
+        head[0] = rev
+        if head is heads[0]:
+            for h in heads[1:]:
+                h[1] = True
+
+    run(['hg', 'update', '-C', 'tip'], cwd=dest)
+    return {
+        'changesets': revs,
+        'files': nfiles,
+        'file_size': size,
+        'churn': opts['hg-churn'],
+        'forks': stats['forks'],
+        'merges': stats['merges'],
+        'bytes': tree_size(os.path.join(dest, '.hg', 'store')),
+    }
+
+def make_zip_series(dest, opts, rng):
+    """Write opts['zips'] archives of the same evolving tree.
+
+    Consecutive archives share all but zip-churn of their members."""
+
+    nzips = opts['zips']
+    nmembers = opts['zip-members']
+    size = opts['zip-member-size']
+    nchurn = min(nmembers, int(nmembers * opts['zip-churn']))
+    content = content_source(rng)
+    version = dict([('src/member%05d.dat' % i, 0) for i in range(nmembers)])
+    names = sorted(version.keys())
+
+    os.mkdir(dest)
+    zips = []
+    total = 0
+    uncompressed = 0
+    for n in range(nzips):
+        if n:
+            for name in rng.sample(names, nchurn):
+                version[name] += 1
+        file = os.path.join(dest, 'bench-%04d.zip' % n)
+        date = time.localtime(1200000000 + n * 86400)[:6]
+        zip = ZipFile(file, 'w', ZIP_DEFLATED)
+        for name in names:
+            info = ZipInfo('project-%04d/%s' % (n, name), date)
+            info.compress_type = ZIP_DEFLATED
+            zip.writestr(info, content.get(name, version[name], size))
+            uncompressed += size
+        zip.close()
+        zips.append(file)
+        total += os.path.getsize(file)
+    return zips, {
+        'archives': nzips,
+        'members': nmembers,
+        'member_size': size,
+        'churn': opts['zip-churn'],
+        'bytes': total,
+        'uncompressed_bytes': uncompressed,
+    }
+
+#------------------------------------------------------------------------------
+
+def install_shims(dir):
+    """Put counting wrappers for git and hg first in PATH.
+
+    Each wrapper appends its name to $BENCH_SPAWN_LOG and execs the
+    real command; the extra exec is the same on every run, so counts
+    and timings stay comparable between reports."""
+
+    os.mkdir(dir)
+    for cmd in counted_commands:
+        real = which(cmd)
+        if not real:
+            continue
+        f = open(os.path.join(dir, cmd), 'w')
+        f.write('#!/bin/sh\necho %s >>"$BENCH_SPAWN_LOG"\nexec "%s" "$@"\n'
+                % (cmd, real))
+        f.close()
+        os.chmod(os.path.join(dir, cmd), 0755)
+
+def measure(cmd, cwd, env, log):
+    """Run cmd to completion; return (seconds, peak RSS in KiB).
+
+    wait4() reports the largest RSS among the process and all the
+    descendants it waited for, which covers every git and hg child."""
+
+    out = open(log, 'a')
+    start = time.time()
+    p = subprocess.Popen(cmd, cwd=cwd, env=env, stdout=out, stderr=out)
+    pid, status, usage = os.wait4(p.pid, 0)
+    elapsed = time.time() - start
+    out.close()
+    if status:
+        die('%s failed, see %s' % (' '.join(cmd), log))
+    rss = usage.ru_maxrss
+    if sys.platform == 'darwin':
+        # reported in bytes there, in KiB everywhere else
+        rss /= 1024
+    return elapsed, rss
+
+def count_commits(repo, ref):
+    p = subprocess.Popen(['git', 'rev-list', ref], cwd=repo,
+                         stdout=subprocess.PIPE)
+    out = p.communicate()[0]
+    return len(out.splitlines())
+
+def bench(name, cmd, setup, units, input, opts, env, shims):
+    """Convert one input opts['repeat'] times and summarize the runs.
+
+    setup(run) prepares a fresh scratch repository and returns it."""
+
+    runs = []
+    for n in range(opts['repeat']):
+        repo = setup(n)
+        spawn_log = os.path.join(opts['workdir'], '%s-%d.spawns' % (name, n))
+        open(spawn_log, 'w').close()
+        run_env = dict(env)
+        run_env['BENCH_SPAWN_LOG'] = spawn_log
+        if shims:
+            run_env['PATH'] = shims + os.pathsep + env['PATH']
+        log = os.path.join(opts['workdir'], '%s-%d.log' % (name, n))
+        note('%s: run %d' % (name, n + 1))
+        elapsed, rss = measure(cmd(repo), repo, run_env, log)
+
+        spawns = dict([(c, 0) for c in counted_commands])
+        for line in open(spawn_log):
+            spawns[line.strip()] += 1
+        spawns['total'] = sum(spawns.values())
+        runs.append({
+            'seconds': round(elapsed, 4),
+            units + '_per_second': round(input[units] / elapsed, 3),
+            'bytes_per_second': round(input['bytes'] / elapsed, 1),
+            'spawns': shims and spawns or None,
+            'peak_rss_kib': rss,
+            'commits': count_commits(repo, '--all'),
+        })
+
+    best = min(runs, key=lambda r: r['seconds'])
+    return {
+        'converter': name,
+        'script': converters[name],
+        'input': input,
+        'runs': runs,
+        'best': best,
+    }
+
+def bench_hg_to_git(opts, env, shims, rng):
+    source = os.path.join(opts['workdir'], 'hg-source')
+    note('hg-to-git: generating %d changesets' % opts['hg-revs'])
+    input = make_hg_history(source, opts, rng)
+
+    def setup(n):
+        # hg-to-git converts in place, so every run gets its own copy
+        repo = os.path.join(opts['workdir'], 'hg-to-git-%d' % n)
+        shutil.copytree(source, repo, symlinks=True)
+        return repo
+
+    def cmd(repo):
+        return [opts['python'], converters['hg-to-git'],
+                '-n', str(opts['hg-nrepack']), repo]
+
+    return bench('hg-to-git', cmd, setup, 'changesets', input,
+                 opts, env, shims)
+
+def bench_import_zips(opts, env, shims, rng):
+    source = os.path.join(opts['workdir'], 'zip-source')
+    note('import-zips: generating %d archives' % opts['zips'])
+    zips, input = make_zip_series(source, opts, rng)
+
+    def setup(n):
+        repo = os.path.join(opts['workdir'], 'import-zips-%d' % n)
+        os.mkdir(repo)
+        run(['git', 'init'], cwd=repo)
+        return repo
+
+    def cmd(repo):
+        return [opts['python'], converters['import-zips']] + zips
+
+    return bench('import-zips', cmd, setup, 'archives', input,
+                 opts, env, shims)
+
+#------------------------------------------------------------------------------
+
+opts = {
+    'output': None,
+    'repeat': 3,
+    'only': None,
+    'python': sys.executable,
+    'seed': 1,
+    'workdir': None,
+    'spawn-count': True,
+    'hg-revs': 100,
+    'hg-files': 50,
+    'hg-file-size': 2048,
+    'hg-churn': 0.1,
+    'hg-branch-every': 10,
+    'hg-merge-every': 15,
+    'hg-nrepack': 0,
+    'zips': 20,
+    'zip-members': 100,
+    'zip-member-size': 4096,
+    'zip-churn': 0.2,
+}
+int_opts = ('repeat', 'seed', 'hg-revs', 'hg-files', 'hg-file-size',
+            'hg-branch-every', 'hg-merge-every', 'hg-nrepack',
+            'zips', 'zip-members', 'zip-member-size')
+float_opts = ('hg-churn', 'zip-churn')
+
+try:
+    optlist, args = getopt.getopt(sys.argv[1:], 'o:r:h',
+        ['output=', 'repeat=', 'only=', 'python=', 'workdir=',
+         'no-spawn-count', 'help'] +
+        [o + '=' for o in int_opts + float_opts if o not in ('repeat',)])
+    for o, a in optlist:
+        if o in ('-h', '--help'):
+            usage()
+            sys.exit(0)
+        elif o in ('-o', '--output'):
+            opts['output'] = a
+        elif o in ('-r', '--repeat'):
+            opts['repeat'] = int(a)
+        elif o == '--no-spawn-count':
+            opts['spawn-count'] = False
+        elif o[2:] in int_opts:
+            opts[o[2:]] = int(a)
+        elif o[2:] in float_opts:
+            opts[o[2:]] = float(a)
+        else:
+            opts[o[2:]] = a
+    if args or opts['repeat'] < 1:
+        raise ValueError('params')
+    if opts['only'] not in (None, 'hg-to-git', 'import-zips'):
+        raise ValueError('params')
+    if opts['hg-revs'] < 1 or opts['hg-files'] < 1 or opts['zips'] < 1:
+        raise ValueError('params')
+    if opts['hg-file-size'] < min_file_size or \
+       opts['zip-member-size'] < min_file_size:
+        raise ValueError('params')
+except (getopt.GetoptError, ValueError):
+    usage()
+    sys.exit(1)
+
+wanted = [c for c in ('hg-to-git', 'import-zips')
+          if opts['only'] in (None, c)]
+if 'hg-to-git' in wanted and not which('hg'):
+    if opts['only']:
+        die('hg is not in PATH')
+    note('hg is not in PATH, skipping hg-to-git')
+    wanted.remove('hg-to-git')
+if not which('git'):
+    die('git is not in PATH')
+
+keep = opts['workdir'] is not None
+if keep:
+    opts['workdir'] = os.path.abspath(opts['workdir'])
+    if not os.path.isdir(opts['workdir']):
+        os.makedirs(opts['workdir'])
+    if os.listdir(opts['workdir']):
+        die('%s is not empty' % opts['workdir'])
+else:
+    opts['workdir'] = tempfile.mkdtemp(prefix='convert-bench-')
+
+# A fixed identity and no user configuration, so runs on different
+# machines do the same work
+env = dict(os.environ)
+env.update({
+    'GIT_AUTHOR_NAME': 'Bench Author',
+    'GIT_AUTHOR_EMAIL': 'bench@example.com',
+    'GIT_COMMITTER_NAME': 'Bench Committer',
+    'GIT_COMMITTER_EMAIL': 'bench@example.com',
+    'GIT_CONFIG_NOSYSTEM': '1',
+    'HOME': opts['workdir'],
+    'HGPLAIN': '1',
+    'HGRCPATH': '',
+    'LC_ALL': 'C',
+})
+os.environ.update(env)
+
+# On failure the work directory is kept, since die() messages point
+# into it
+try:
+    shims = None
+    if opts['spawn-count']:
+        shims = os.path.join(opts['workdir'], 'shims')
+        install_shims(shims)
+
+    report = {
+        'format': format_version,
+        'date': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'host': {
+            'platform': platform.platform(),
+            'machine': platform.machine(),
+            'python': platform.python_version(),
+            'git': run(['git', '--version']).strip(),
+        },
+        'options': dict([(k, v) for k, v in opts.items()
+                         if k not in ('output', 'workdir')]),
+        'results': [],
+    }
+    if 'hg-to-git' in wanted:
+        report['host']['hg'] = run(['hg', '--version']).splitlines()[0]
+
+    for name in wanted:
+        rng = random.Random(opts['seed'])
+        if name == 'hg-to-git':
+            result = bench_hg_to_git(opts, env, shims, rng)
+        else:
+            result = bench_import_zips(opts, env, shims, rng)
+        report['results'].append(result)
+except:
+    if not keep:
+        note('keeping %s' % opts['workdir'])
+    raise
+if not keep:
+    shutil.rmtree(opts['workdir'], ignore_errors=True)
+
+if opts['output']:
+    out = open(opts['output'], 'w')
+else:
+    out = sys.stdout
+json.dump(report, out, indent=1, sort_keys=True)
+out.write('\n')
+if out is not sys.stdout:
+    out.close()
+
+# vim: et ts=8 sw=4 sts=4
@@ -13,6 +13,7 @@ import os
 import sys
 import time
 import getopt
+import re
 
 from signal import signal, \
    SIGPIPE, SIGINT, SIG_DFL, \
@@ -153,6 +154,110 @@ class p4_command:
         self.date = self._format_date(time.localtime(long(desc['time'])))
         return self
 
+class p4_index:
+    """Record of the changes imported into one git branch.
+
+    The index lives in $GIT_DIR/p4import/<branch> and holds one
+    "<commit> <change>" line per imported change, oldest first.  Lines
+    are appended before the branch is advanced, so finding where to
+    resume only reads the last two; an interrupted import at worst
+    leaves one line past the branch head, which is dropped on the
+    next run.  Any other disagreement with the branch is left for the
+    user to sort out."""
+
+    record = re.compile('^([0-9a-f]{40,64}) ([0-9]+)$')
+    tailsize = 256
+
+    def __init__(self, gitdir, branch):
+        self.path = os.path.join(gitdir, "p4import", branch)
+        self.exists = os.path.exists(self.path)
+        self.tail = []
+        if self.exists:
+            self.read_tail()
+
+    def parse(self, line):
+        m = self.record.match(line)
+        if not m:
+            die("Malformed p4import index %s:" % self.path, repr(line))
+        return (m.group(1), int(m.group(2)))
+
+    def read_tail(self):
+        # Keep (offset, commit, change) of the last two records in
+        # self.tail, dropping a record torn by an interrupted append
+        f = open(self.path, "r+b")
+        f.seek(0, 2)
+        end = f.tell()
+        start = max(0, end - self.tailsize)
+        f.seek(start)
+        data = f.read()
+        cut = data.rfind("\n") + 1
+        if cut < len(data):
+            f.truncate(start + cut)
+            data = data[:cut]
+        f.close()
+        pos = len(data)
+        while pos > 0 and len(self.tail) < 2:
+            begin = data.rfind("\n", 0, pos - 1) + 1
+            if begin == 0 and start > 0:
+                if not self.tail:
+                    die("Malformed p4import index %s:" % self.path,
+                        "record too long")
+                break
+            commit, change = self.parse(data[begin:pos - 1])
+            self.tail.insert(0, (start + begin, commit, change))
+            pos = begin
+
+    def find(self, head):
+        # Slow path for a branch reset to an earlier imported commit
+        f = open(self.path, "rb")
+        lines = f.read().splitlines()
+        f.close()
+        lines.reverse()
+        for l in lines:
+            commit, change = self.parse(l)
+            if commit == head:
+                return change
+        return None
+
+    def top(self, head, is_ancestor):
+        """Return the last change imported into head, None without index."""
+        if not self.tail:
+            if self.exists and head != "":
+                die("No imported change recorded in", self.path)
+            return None
+        pos, commit, change = self.tail[-1]
+        if commit == head:
+            return change
+        if len(self.tail) > 1:
+            before = self.tail[-2][1]
+        else:
+            before = ""
+        if before == head:
+            report(1, "Dropping change", change, "from an interrupted import")
+            f = open(self.path, "r+b")
+            f.truncate(pos)
+            f.close()
+            if head == "":
+                return None
+            return self.tail[-2][2]
+        if head == "":
+            die("Branch does not exist but %s does; remove it to start over"
+                % self.path)
+        if is_ancestor(commit, head):
+            return change
+        change = self.find(head)
+        if change == None:
+            die("Branch head is not a descendant of any change in", self.path)
+        return change
+
+    def add(self, id, commit):
+        dir = os.path.dirname(self.path)
+        if not os.path.isdir(dir):
+            os.makedirs(dir)
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0666)
+        os.write(fd, "%s %s\n" % (commit, id))
+        os.close(fd)
+
 class git_command:
     def __init__(self):
         try:
@@ -160,7 +265,7 @@ class git_command:
         except:
             die("Could not find the \"git\" command")
         try:
-            self.gitdir = self.get_single("rev-parse --git-dir")
+            self.gitdir = os.path.abspath(self.get_single("rev-parse --git-dir"))
             report(2, "gdir:", self.gitdir)
         except:
             die("Not a git repository... did you forget to \"git init\" ?")
@@ -206,7 +311,27 @@ class git_command:
     def make_tag(self, name, head):
         self.git("tag -f %s %s"%(name,head))
 
+    def open_index(self, branch):
+        self.index = p4_index(self.gitdir, branch)
+
+    def is_ancestor(self, commit, head):
+        r = self.git("merge-base %s %s" % (commit, head))
+        if self.ret == None:
+            return r[0].rstrip() == commit
+        if self.ret >> 8 == 1:
+            # no common ancestor at all
+            return False
+        die("Could not run git merge-base", commit, head)
+
     def top_change(self, branch):
+        try:
+            head = self.get_single("rev-parse --verify refs/heads/%s" % branch)
+        except:
+            head = ""
+        top = self.index.top(head, self.is_ancestor)
+        if top != None:
+            return top
+        # imported before there was an index, find the last p4/ tag
         try:
             a=self.get_single("name-rev --tags refs/heads/%s" % branch)
             loc = a.find(' tags/') + 6
@@ -241,7 +366,7 @@ class git_command:
     def basedir(self):
         return self.topdir
 
-    def commit(self, author, email, date, msg, id):
+    def commit(self, author, email, date, msg, id, tag):
         self.update_index()
         fd=open(".msg", "w")
         fd.writelines(msg)
@@ -258,7 +383,8 @@ class git_command:
             os.environ['GIT_COMMITTER_%s'%r] = l
         commit = self.get_single("commit-tree %s %s < .msg" % (tree,head))
         os.remove(".msg")
-        self.make_tag("p4/%s"%id, commit)
+        self.make_tag(tag, commit)
+        self.index.add(id, commit)
         self.git("update-ref HEAD %s %s" % (commit, current) )
 
 try:
@@ -318,6 +444,7 @@ if p4.where()[:len(localdir)] != localdir:
     if ignore_warnings != True:
         die("Reconfigure or use \"--ignore\" on command line")
 
+git.open_index(branch)
 if stitch == 0:
     top = git.top_change(branch)
 else:
@@ -352,9 +479,10 @@ for id in changes:
     change = p4.describe(id)
     p4.sync(id)
     if tagall :
-            git.commit(change.author, change.email, change.date, change.msg, id)
+            tag = "p4/%s" % id
     else:
-            git.commit(change.author, change.email, change.date, change.msg, "import")
+            tag = "import"
+    git.commit(change.author, change.email, change.date, change.msg, id, tag)
     if stitch == 1:
         git.clean_directories()
         stitch = 0